@@ -1,42 +1,95 @@
 """
 Functions used to transform downloaded data into BIDS format
 """
+import functools
 import json
 import os
 import re
+import shutil
 import tempfile
 import zipfile
 import logging
 
+from .utils import get_files
+
+# orjson is optional but parses JSON sidecars considerably faster if available
+try:
+    import orjson
+    def load_json(f):
+        data = f.read()
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # e.g. NaN or Infinity values which orjson rejects but json accepts
+            return json.loads(data)
+except ImportError:
+    def load_json(f):
+        return json.load(f)
+
 LOG = logging.getLogger(__name__)
 
+# Single pattern used to extract echo and coil numbers from file names, so each
+# file name is only scanned once. Group 1 is the echo number, group 2 the coil number
+_FNAME_RE = re.compile(r"_e(?:cho)?(\d+)(?=[_$]|$)|coil(\d+)", re.IGNORECASE)
+
+def _parse_fname(fname):
+    """
+    Extract (echo number, coil number) from a file name - either may be None
+
+    Where a number occurs more than once the last occurrence is used
+    """
+    echonum, coilnum = None, None
+    for match in _FNAME_RE.finditer(fname):
+        if match.group(1) is not None:
+            echonum = int(match.group(1))
+        else:
+            coilnum = int(match.group(2))
+    return echonum, coilnum
+
 def get_echo_num(fname, json_data):
     """
     Try to identify the echo number if possible
     """
-    echo_res = [re.compile(".*_echo(\d+)[_$]"), re.compile(".*_e(\d+)[_$]")]
     if "EchoNumber" in json_data:
         return json_data["EchoNumber"]
-
-    for echo_re in echo_res:
-        match = echo_re.match(fname.lower())
-        if match:
-            return int(match.group(1))
+    return _parse_fname(fname)[0]
 
 def get_coil_num(fname, json_data):
-    pattern = re.compile(".*coil(\d+).*")
-    match= pattern.match(fname.lower())
-    if match:
-        return int(match.group(1))
+    return _parse_fname(fname)[1]
+
+def get_desc(json_data):
+    """
+    Get the lower case series description used to match files
+    """
+    return json_data.get("SeriesDescription", "").lower()
+
+def get_img_types(json_data):
+    """
+    Get the set of upper case image types used to match files
+    """
+    return frozenset(s.upper() for s in json_data.get("ImageType", []))
+
+def keywords(*kws):
+    """
+    Declare keywords, at least one of which must appear in the lower case series
+    description for a matcher to match. Matchers without keywords are always tried
+    """
+    def _decorator(matcher):
+        matcher.keywords = kws
+        return matcher
+    return _decorator
 
 # Matchers return tuple of (subfolder, suffix, dict of additional filename attributes, dict of json updates)
-# or None if file did not match
-def match_anat(fname, json_data):
+# or None if file did not match. The lower case series description and upper case image
+# types may be passed in so they are only computed once per file when trying multiple matchers
+@keywords("t1", "t2")
+def match_anat(fname, json_data, desc=None, img_types=None):
     """
     Match anatomical images
     """
     folder, suffix, attrs, md = "anat", None, {}, {}
-    desc = json_data.get("SeriesDescription", "").lower()
+    if desc is None:
+        desc = get_desc(json_data)
     if "t1" in desc:
         suffix = "T1w"
     elif "t2star" in desc:
@@ -45,7 +98,8 @@ def match_anat(fname, json_data):
         suffix = "T2w"
 
     if suffix:
-        img_types = [s.upper() for s in json_data.get("ImageType", [])]
+        if img_types is None:
+            img_types = get_img_types(json_data)
         if "NORM" in img_types:
             attrs["acq"] = "norm"
         if "PHASE" in img_types:
@@ -58,12 +112,14 @@ def match_anat(fname, json_data):
         #    attrs["echo"] = echonum
         return folder, suffix, attrs, md
 
-def match_func(fname, json_data):
+@keywords("fmri")
+def match_func(fname, json_data, desc=None, img_types=None):
     """
     Match functional images
     """
     folder, suffix, attrs, md = "func", None, {}, {}
-    desc = json_data.get("SeriesDescription", "").lower()
+    if desc is None:
+        desc = get_desc(json_data)
     if "fmri" in desc:
         if "sbref" in desc:
             suffix = "sbref"
@@ -78,12 +134,14 @@ def match_func(fname, json_data):
         
         return folder, suffix, attrs, md
 
-def match_dwi(fname, json_data):
+@keywords("diff")
+def match_dwi(fname, json_data, desc=None, img_types=None):
     """
     Match DWI images
     """
     folder, suffix, attrs, md = "dwi", None, {}, {}
-    desc = json_data.get("SeriesDescription", "").lower()
+    if desc is None:
+        desc = get_desc(json_data)
     if "diff" in desc:
         if "sbref" in desc:
             suffix = "sbref"
@@ -92,23 +150,25 @@ def match_dwi(fname, json_data):
 
         return folder, suffix, attrs, md
 
-def match_swi(fname, json_data):
+@keywords("swi")
+def match_swi(fname, json_data, desc=None, img_types=None):
     """
     Match SWI images
     """
     folder, suffix, attrs, md = "swi", None, {}, {}
-    desc = json_data.get("SeriesDescription", "").lower()
+    if desc is None:
+        desc = get_desc(json_data)
     if "swi" in desc:
         if "sbref" in desc:
             suffix = "sbref"
         else:
             suffix = "swi"
 
-        echonum = get_echo_num(fname, json_data)
+        echonum, coilnum = _parse_fname(fname)
+        echonum = json_data.get("EchoNumber", echonum)
         if echonum:
             attrs["echo"] = echonum
 
-        coilnum = get_coil_num(fname, json_data)
         if coilnum:
             attrs["coil"] = coilnum
 
@@ -121,6 +181,84 @@ DEFAULT_MATCHER = [
     match_swi,
 ]
 
+# File extensions which make up a single BIDS image. Longer extensions must
+# come first so .nii.gz is not mistaken for .nii
+EXTS = (".nii.gz", ".nii", ".json", ".bval", ".bvec")
+
+def strip_ext(fname):
+    """
+    Remove a BIDS image extension from the end of a file name, if present
+    """
+    for ext in EXTS:
+        if fname.endswith(ext):
+            return fname[:-len(ext)]
+    return fname
+
+# Matches the BIDS 'run' attribute in a file name
+_RUN_RE = re.compile(r"_run-(\d+)(?=_)")
+
+def get_bids_fname(attrs, suffix):
+    """
+    Get the BIDS file name (without subject/session prefix or extension) from
+    the filename attributes and suffix
+    """
+    return "_".join([f"{k}-{v}" for k, v in attrs.items()] + [suffix])
+
+def get_runs(folder):
+    """
+    Find the runs already present in a BIDS subfolder
+
+    :return: Dictionary mapping file name (without extension or 'run' attribute)
+             to the highest run number present. A file without a 'run' attribute
+             is recorded as run 0
+    """
+    runs = {}
+    for entry in os.scandir(folder):
+        stem = strip_ext(entry.name)
+        match = _RUN_RE.search(stem)
+        if match:
+            stem, run = stem[:match.start()] + stem[match.end():], int(match.group(1))
+        else:
+            run = 0
+        runs[stem] = max(runs.get(stem, 0), run)
+    return runs
+
+@functools.lru_cache(maxsize=512)
+def candidate_matchers(desc, bids_mapper):
+    """
+    Get the matchers which could match a series description, in priority order
+
+    :param bids_mapper: Tuple of matchers
+    """
+    candidates = []
+    for matcher in bids_mapper:
+        kws = getattr(matcher, "keywords", None)
+        if not kws or any(kw in desc for kw in kws):
+            candidates.append(matcher)
+    return tuple(candidates)
+
+def match_image(imgname, json_data, bids_mapper):
+    """
+    Find the first matcher which matches an image
+
+    :return: Matcher result, or None if no matcher matched
+    """
+    desc, img_types = get_desc(json_data), get_img_types(json_data)
+    for matcher in candidate_matchers(desc, tuple(bids_mapper)):
+        bids_match = matcher(imgname, json_data, desc, img_types)
+        if bids_match:
+            return bids_match
+
+# Participants already listed in participants.tsv, keyed by BIDS directory. This
+# avoids re-reading the file for every scan downloaded in the same run
+_PT_CACHE = {}
+
+def flush_pt_cache():
+    """
+    Forget cached participant lists so they are re-read from disk on next use
+    """
+    _PT_CACHE.clear()
+
 def update_ptlist(bidsdir, bids_subject, subject):
     """
     Update participants list
@@ -128,17 +266,29 @@ def update_ptlist(bidsdir, bids_subject, subject):
     FIXME no additional pt data currently written
     """
     pts_file = os.path.join(bidsdir, "participants.tsv")
-    if os.path.exists(pts_file):
-        with open(pts_file) as f:
-            pts = [l.strip() for l in f.readlines()]
-    else:
-        pts = ["participant_id",]
-
-    if bids_subject not in pts[1:]:
-        pts.append(bids_subject)
-        with open(pts_file, "w") as f:
-            for pt in pts:
-                f.write("%s\n" % pt)
+    pts = _PT_CACHE.get(bidsdir)
+    if pts is None:
+        pts = set()
+        content = ""
+        if os.path.exists(pts_file):
+            with open(pts_file) as f:
+                content = f.read()
+            pts = {l.strip() for l in content.splitlines()[1:]} # Skip header
+
+        if not content.strip():
+            # New or empty file
+            with open(pts_file, "w") as f:
+                f.write("participant_id\n")
+        elif not content.endswith("\n"):
+            # e.g. edited outside xnatc - make sure new rows start on a new line
+            with open(pts_file, "a") as f:
+                f.write("\n")
+        _PT_CACHE[bidsdir] = pts
+
+    if bids_subject not in pts:
+        with open(pts_file, "a") as f:
+            f.write("%s\n" % bids_subject)
+        pts.add(bids_subject)
 
 TEMPLATE_DATASET_DESC = {
   "Name": None,
@@ -165,10 +315,17 @@ def check_dataset_description(bidsdir, project):
         with open(readme_file, 'w') as f:
             f.write(readme)
 
+# Prefix of the hidden folder within a session that scan files are downloaded to
+# before being moved into the BIDS dataset
+STAGING_PREFIX = ".xnatc-download-"
+
+# BIDS does not allow hyphen or underscore in IDs - translation table to remove them
+BIDS_ID_STRIP = str.maketrans("", "", "_-")
+
 def download_bids(obj, obj_type, args, path):
     if obj_type != "scan":
         # Only download individual scans
-        return
+        return False
 
     print("Downloading %s: %s in BIDS format" % (obj_type, obj.label()))
     r = obj.resource(args.download_resource)
@@ -176,10 +333,9 @@ def download_bids(obj, obj_type, args, path):
     subj = exp.parent()
     proj = subj.parent()
     
-    # BIDS does not allow hyphen or underscore in IDs
-    bids_project = proj.label().replace("_", "").replace("-", "")
-    bids_subject = "sub-" + subj.label().replace("_", "").replace("-", "")
-    bids_session = "ses-" + exp.label().replace("_", "").replace("-", "")
+    bids_project = proj.label().translate(BIDS_ID_STRIP)
+    bids_subject = "sub-" + subj.label().translate(BIDS_ID_STRIP)
+    bids_session = "ses-" + exp.label().translate(BIDS_ID_STRIP)
 
     bidsdir = os.path.join(args.download, bids_project)
     outdir = os.path.join(bidsdir, bids_subject, bids_session)
@@ -190,74 +346,102 @@ def download_bids(obj, obj_type, args, path):
     update_ptlist(bidsdir, bids_subject, subj)
     check_dataset_description(bidsdir, proj)
 
-    # Download the NIFTI data and metadata
-    # Set of all file name without extensions. Since we're dealing with
-    # a single scan there will normally be only one
-    imgfiles = set()
+    # Group the resource files by image name (file name without extension). Since
+    # we're dealing with a single scan there will normally be only one image
+    images = {}
+    for f in r.files():
+        name = os.path.basename(f.label())
+        images.setdefault(strip_ext(name), []).append((f, name))
 
-    # Copy expected files to output dir. Not given standard names or subfolders yet
-    EXTS = (".nii.gz", ".nii", ".json", ".bval", ".bvec")
-        
-    for idx, f in enumerate(r.files()):
-        #f.get(os.path.join(download_path, f.label()))
-        name = f.label()
-        imgname = os.path.basename(name)
-        for ext in EXTS:
-            imgname = imgname.replace(ext, "")
-        imgfiles.add(imgname)
-        f.get(os.path.join(outdir, os.path.basename(name)))
-
-    # Rename files according to matcher rules
-    for imgname in imgfiles:
-        json_fname = os.path.join(outdir, imgname + ".json")
-        if not os.path.exists(json_fname):
-            LOG.warn(f"No JSON sidecar for {imgname} - may not be able to match file")
+    # Download to a staging folder and only move files into place once the whole
+    # scan is complete. Remove any staging folders left by a killed run first
+    with os.scandir(outdir) as entries:
+        for entry in entries:
+            if entry.name.startswith(STAGING_PREFIX) and entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+    staging_dir = tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=outdir)
+    try:
+        return _download_scan(images, staging_dir, outdir, bids_subject, bids_session, bids_mapper, args)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+def _download_scan(images, staging_dir, outdir, bids_subject, bids_session, bids_mapper, args):
+    """
+    Download and match the images in a scan and move them into the BIDS dataset
+
+    :return: True if any images were added to the dataset
+    """
+    # Download the JSON sidecars first so each image can be matched using its
+    # metadata. Image data is then only downloaded for images which match
+    get_files([(f, os.path.join(staging_dir, name)) for files in images.values() for f, name in files if name.endswith(".json")], args.jobs)
+
+    # Existing runs in each BIDS subfolder are found by listing it once when first used
+    folder_runs = {}
+    downloads, moves = [], []
+    for imgname, files in images.items():
+        json_fname = os.path.join(staging_dir, imgname + ".json")
+        try:
+            with open(json_fname, "rb") as json_file:
+                json_data = load_json(json_file)
+        except FileNotFoundError:
+            LOG.warning("No JSON sidecar for %s - may not be able to match file", imgname)
             json_data = {}
-        else:
-            try:
-                with open(os.path.join(outdir, imgname + ".json")) as json_file:
-                    json_data = json.load(json_file)
-            except Exception as exc:
-                LOG.warn("Error reading JSON metadat: %s - may not be able to match file", str(exc))
-                json_data = {}
-        found = False
-        for matcher in bids_mapper:
-            bids_match = matcher(imgname, json_data)
-            if bids_match:
-                folder, suffix, attrs, md = bids_match
-                os.makedirs(os.path.join(outdir, folder), exist_ok=True)
-                mapped = False
+        except (OSError, ValueError) as exc:
+            LOG.warning("Error reading JSON metadata: %s - may not be able to match file", exc)
+            json_data = {}
+
+        bids_match = match_image(imgname, json_data, bids_mapper)
+        if not bids_match:
+            LOG.warning("Unmatched file: %s - not including in BIDS dataset", imgname)
+            continue
+
+        folder, suffix, attrs, md = bids_match
+        dest_dir = os.path.join(outdir, folder)
+        if folder not in folder_runs:
+            os.makedirs(dest_dir, exist_ok=True)
+            folder_runs[folder] = get_runs(dest_dir)
+        runs = folder_runs[folder]
+
+        # Avoid overwriting existing files with same name by adding the
+        # BIDS 'run' attribute to distinguish between them
+        bids_fname = get_bids_fname(attrs, suffix)
+        stem = f"{bids_subject}_{bids_session}_{bids_fname}"
+        last_run = runs.get(stem)
+        if last_run is not None:
+            if last_run == 0:
+                # Existing file lacks the 'run' attribute so first we need to designate it as 'run 1', then
+                # the new conflicting file becomes 'run 2'
+                attrs["run"] = 1
+                run1_stem = f"{bids_subject}_{bids_session}_{get_bids_fname(attrs, suffix)}"
                 for ext in EXTS:
-                    src_fname = os.path.join(outdir, imgname + ext)
-                    while 1:
-                        # Ugly code to avoid overwriting existing files with same name by adding the
-                        # BIDS 'run' attribute to distinguish between them
-                        bids_fname = "_".join(["%s-%s" % (k, v) for k, v in attrs.items()] + [suffix])
-                        dest_fname = os.path.join(outdir, folder, "%s_%s_%s%s" % (bids_subject, bids_session, bids_fname, ext))
-                        if os.path.exists(dest_fname):
-                            if "run" not in attrs:
-                                # Existing file lacks the 'run' attribute so first we need to designate it as 'run 1', then
-                                # the new conflicting file can be tried out as 'run 2'
-                                attrs["run"] = 1
-                                rename_existing_bids_fname = "_".join(["%s-%s" % (k, v) for k, v in attrs.items()] + [suffix])
-                                rename_existing_dest_fname = os.path.join(outdir, folder, "%s_%s_%s%s" % (bids_subject, bids_session, rename_existing_bids_fname, ext))
-                                os.rename(dest_fname, rename_existing_dest_fname)
-                                attrs["run"] = 2
-                            else:
-                                attrs["run"] += 1
-                        else:
-                            if not mapped:
-                                print(f"Mapping {imgname} -> {folder} / {bids_fname}")
-                                mapped = True
-                            attrs.pop("run", None)
-                            break
-
-                    if os.path.exists(src_fname):
-                        os.rename(src_fname, dest_fname)
-                found = True
-                break
-        if not found:
-            LOG.warn(f"Unmatched file: {imgname} - removing from BIDS dataset")
-            for ext in EXTS:
-                if os.path.exists(os.path.join(outdir, imgname + ext)):
-                    os.remove(os.path.join(outdir, imgname + ext))
+                    existing_fname = os.path.join(dest_dir, stem + ext)
+                    if os.path.exists(existing_fname):
+                        os.replace(existing_fname, os.path.join(dest_dir, run1_stem + ext))
+                # The existing image may be from this scan, with its files still
+                # waiting to be moved to the run-less name
+                for idx, (staged_fname, dest) in enumerate(moves):
+                    for ext in EXTS:
+                        if dest == os.path.join(dest_dir, stem + ext):
+                            moves[idx] = (staged_fname, os.path.join(dest_dir, run1_stem + ext))
+                last_run = 1
+            attrs["run"] = last_run + 1
+            bids_fname = get_bids_fname(attrs, suffix)
+            runs[stem] = last_run + 1
+        else:
+            runs[stem] = 0
+
+        print(f"Mapping {imgname} -> {folder} / {bids_fname}")
+        dest_stem = os.path.join(dest_dir, f"{bids_subject}_{bids_session}_{bids_fname}")
+        for f, name in files:
+            ext = name[len(imgname):]
+            if ext == ".json":
+                moves.append((json_fname, dest_stem + ext))
+            elif ext in EXTS:
+                staged_fname = os.path.join(staging_dir, name)
+                downloads.append((f, staged_fname))
+                moves.append((staged_fname, dest_stem + ext))
+
+    get_files(downloads, args.jobs)
+    for staged_fname, dest in moves:
+        os.replace(staged_fname, dest)
+    return bool(moves)
@@ -3,16 +3,28 @@ xnatc - Command line interface to XNAT
 """
 import argparse
 import fnmatch
+import functools
 import getpass
+import json
 import netrc
 import os
 import re
 import sys
-from urllib.parse import urlparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlparse
 
 import pyxnat
 
 from . import bids
+from .utils import get_resource
+
+@functools.lru_cache(maxsize=1)
+def load_netrc():
+    """
+    Parse $HOME/.netrc - only done once per process however many times credentials are needed
+    """
+    return netrc.netrc()
 
 def get_auth(args):
     if args.user and args.password:
@@ -22,7 +34,7 @@ def get_auth(args):
         args.xnat = 'https://' + args.xnat
     url = urlparse(args.xnat)
     try:
-        auth_data = netrc.netrc()
+        auth_data = load_netrc()
         if url.hostname in auth_data.hosts:
             args.user, _account, args.password = auth_data.authenticators(url.hostname)
     except:
@@ -37,6 +49,17 @@ def get_auth(args):
         print("  Note: You can add your credentials to $HOME/.netrc for automatic login")
         print("        See https://xnat.readthedocs.io/en/latest/static/tutorial.html#credentials")
 
+def configure_http(conn, args):
+    """
+    Configure connection pooling and retries on the HTTP session used by pyxnat
+    """
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(10, args.jobs),
+                          max_retries=Retry(total=3, backoff_factor=0.2))
+    conn._http.mount("https://", adapter)
+    conn._http.mount("http://", adapter)
+
 def main():
     parser = argparse.ArgumentParser(description='Command line interface to XNAT')
     g = parser.add_argument_group("XNAT connection")
@@ -55,15 +78,18 @@ def main():
     g.add_argument('--download', help='Download data to named directory')
     g.add_argument('--download-resource', help='Name of resource type to download', default='DICOM')
     g.add_argument('--download-format', help='Download format', default="xnat", choices=["xnat", "bids"])
+    g.add_argument('--resume', action="store_true", help='Skip objects already downloaded by a previous run into the same directory, e.g. after an interrupted download')
     #g.add_argument('--bids-mapper', help='BIDS mapper', default="default")
     g = parser.add_argument_group("Uploading data")
     g.add_argument('--upload', help='File or directory containing data to upload to a scan/assessor')
     g.add_argument('--upload-resource', help='Resource type for uploaded data - if not specified will try to autodetect from file type')
     g.add_argument('--upload-name', help='Name to give uploaded data - defaults to file basename')
     g.add_argument('--create-assessor', help='File containing XML definition of assessor to create')
+    parser.add_argument('--jobs', type=int, default=4, help='Number of parallel downloads or uploads. Use 1 to transfer one file/object at a time')
     parser.add_argument('--debug', action="store_true", help='Enable debug mode')
     args = parser.parse_args()
     args.list_children = True
+    load_match_files(args)
 
     get_auth(args)
     import urllib3
@@ -71,6 +97,7 @@ def main():
 
     connection = pyxnat.Interface(server=args.xnat, user=args.user, password=args.password, verify=False)
     connection.xnat_url = args.xnat
+    configure_http(connection, args)
 
     if args.download:
         if args.download_format == "bids" and not args.download_resource == "NIFTI":
@@ -78,9 +105,9 @@ def main():
             args.download_resource = "NIFTI"
 
         if args.download_format == "bids":
-            do_list(connection, args, action=bids.download_bids)
+            do_list(connection, args, action=resumable(bids.download_bids, args))
         elif args.download_format == "xnat":
-            do_list(connection, args, action=download_obj)
+            do_list_parallel(connection, args, action=resumable(download_obj, args))
         else:
             print("Unknown download format: %s" % args.download_format)
             sys.exit(1)
@@ -101,11 +128,75 @@ def main():
         do_list(connection, args)
 
 def label(obj):
+    """
+    Get the label of an XNAT object, cached as pyxnat queries the server every time
+    """
     try:
-        return obj.label()
+        return obj._xnatc_label
+    except AttributeError:
+        pass
+
+    try:
+        obj._xnatc_label = obj.label()
     except Exception as exc:
         print("WARNING: %s" % str(exc))
         return "UNKNOWN"
+    return obj._xnatc_label
+
+def obj_id(obj):
+    """
+    Get the ID of an XNAT object, cached as for the label
+    """
+    try:
+        return obj._xnatc_id
+    except AttributeError:
+        obj._xnatc_id = obj.id()
+        return obj._xnatc_id
+
+# Characters which make a glob match specification a pattern rather than a literal ID
+GLOB_CHARS = re.compile(r"[*?\[]")
+
+# Columns containing the ID and label of each type of object in XNAT collection listings
+LIST_COLUMNS = {
+    "projects" : ("ID", "ID"),
+    "subjects" : ("ID", "label"),
+    "experiments" : ("ID", "label"),
+    "scans" : ("ID", "ID"),
+    "assessors" : ("ID", "label"),
+}
+
+def list_children(coll):
+    """
+    Get the objects in a pyxnat collection, e.g. the subjects of a project, with their IDs
+    and labels fetched in a single query for the whole collection and cached on the objects
+    """
+    try:
+        return _list_children(coll)
+    except AttributeError:
+        # pyxnat internals have changed - IDs and labels are queried for each object instead
+        return list(coll)
+
+def _list_children(coll):
+    collection_type = coll._cbase.rsplit("/", 1)[-1]
+    id_col, label_col = LIST_COLUMNS.get(collection_type, ("ID", "ID"))
+    if label_col == id_col:
+        children = list(coll)
+        for child in children:
+            child._xnatc_id = child._urn
+            child._xnatc_label = child._urn
+        return children
+
+    element_class = getattr(pyxnat.core.resources, collection_type.rstrip("s").title())
+    children = []
+    # Note that pyxnat returns an empty list if the query fails, as when iterating
+    for row in coll._call([id_col, label_col]):
+        child_id = unquote(row[id_col])
+        if fnmatch.fnmatch(child_id, coll._pattern):
+            child = element_class("%s/%s" % (coll._cbase, child_id), coll._intf)
+            child._xnatc_id = child._urn
+            child._xnatc_label = row[label_col]
+            children.append(child)
+    return children
 
 def do_create_assessor(conn, args):
     res = find(conn, args)
@@ -132,25 +223,62 @@ def do_upload(conn, args):
     obj, obj_type, path = res
     if os.path.isdir(args.upload):
         print("Uploading contents of %s as resource for %s: %s" % (args.upload,obj_type, label(obj)))
-        for fname in os.listdir(args.upload):
-            fpath = os.path.join(args.upload, fname)
-            if os.path.isdir(fpath):
-                for sub_fname in os.listdir(fpath):
-                    sub_fpath = os.path.join(fpath, sub_fname)
-                    upload_file(conn, path, fname, sub_fpath)
-            else:
-                upload_file(conn, path, args.upload_resource, fpath)
+        # Subdirectories are uploaded as resources named after the subdirectory
+        uploads = []
+        with os.scandir(args.upload) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    with os.scandir(entry.path) as sub_entries:
+                        for sub_entry in sub_entries:
+                            uploads.append((entry.name, sub_entry.path))
+                else:
+                    uploads.append((args.upload_resource, entry.path))
+        upload_files(conn, path, uploads, args.jobs)
     else:
         print("Uploading %s as %s resource for %s: %s" % (args.upload, args.upload_resource, obj_type, label(obj)))
         upload_file(conn, path, args.upload_resource, args.upload, args.upload_name)
 
     return True
 
+def upload_files(conn, path, uploads, jobs=1):
+    """
+    Upload multiple files as resources of an XNAT object
+
+    :param uploads: Sequence of (resource type, local file name) pairs
+    """
+    first_uploads, other_uploads = [], []
+    resource_types = set()
+    for resource_type, fname in uploads:
+        resource_type = get_resource_type(resource_type, fname)
+        if resource_type in resource_types:
+            other_uploads.append((resource_type, fname))
+        else:
+            first_uploads.append((resource_type, fname))
+            resource_types.add(resource_type)
+
+    # Upload the first file of each resource on its own so it is only created once
+    for resource_type, fname in first_uploads:
+        upload_file(conn, path, resource_type, fname)
+
+    if jobs > 1 and len(other_uploads) > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            list(executor.map(lambda upload: upload_file(conn, path, *upload), other_uploads))
+    else:
+        for resource_type, fname in other_uploads:
+            upload_file(conn, path, resource_type, fname)
+
+def get_resource_type(resource_type, fname):
+    """
+    Get the resource type for an uploaded file, detecting it from the file type if not specified
+    """
+    if not resource_type and (fname.lower().endswith(".nii") or fname.lower().endswith(".nii.gz")):
+        resource_type = 'NIFTI'
+    return resource_type
+
 def upload_file(conn, path, resource_type, fname, upload_name=None):
     if not upload_name:
         upload_name = os.path.basename(fname)
-    if not resource_type and (fname.lower().endswith(".nii") or fname.lower().endswith(".nii.gz")):
-        resource_type = 'NIFTI'
+    resource_type = get_resource_type(resource_type, fname)
 
     if resource_type:
         path = "/data/%s/resources/%s/files/%s" % (path, resource_type, upload_name)
@@ -165,145 +293,351 @@ def find(conn, args):
     """
     Find a specific object based on args passed
     """
-    path=""
-    projects = conn.select.projects()
+    path = []
+    projects = list_children(conn.select.projects())
+    project = args.project.lower()
     found = False
     for p in projects:
-        if exact_match(p, args.project):
-            path += "projects/" + p.id()
+        if exact_match(p, project):
+            path += ["projects", obj_id(p)]
             found = True
             break
     if not found:
         return
     elif not args.subject:
-        return p, "project", path
+        return p, "project", "/".join(path)
 
     found = False
-    for s in p.subjects():
-        if exact_match(s, args.subject):
-            path += "/subjects/" + s.id()
+    subject = args.subject.lower()
+    for s in list_children(p.subjects()):
+        if exact_match(s, subject):
+            path += ["subjects", obj_id(s)]
             found = True
             break
     if not found:
         return
     elif not args.experiment:
-        return s, "subject", path
+        return s, "subject", "/".join(path)
 
     found = False
-    for e in s.experiments():
-        if exact_match(e, args.experiment):
-            path += "/experiments/" + e.id()
+    experiment = args.experiment.lower()
+    for e in list_children(s.experiments()):
+        if exact_match(e, experiment):
+            path += ["experiments", obj_id(e)]
             found = True
             break
     if not found:
         return
     elif not args.scan and not args.assessor:
-        return e, "experiment", path
+        return e, "experiment", "/".join(path)
 
     found = False
     if args.scan:
-        for s in e.scans():
-            if exact_match(s, args.scan):
-                path += "/scans/" + s.id()
+        scan = args.scan.lower()
+        for s in list_children(e.scans()):
+            if exact_match(s, scan):
+                path += ["scans", obj_id(s)]
                 found = True
                 s_type = "scan"
                 break
     elif args.assessor:
-        for s in e.assessors():
-            if exact_match(s, args.assessor):
-                path += "/assessors/" + s.id()
+        assessor = args.assessor.lower()
+        for s in list_children(e.assessors()):
+            if exact_match(s, assessor):
+                path += ["assessors", obj_id(s)]
                 found = True
                 s_type = "assessor"
                 break
     if not found:
         return
     else:
-        return s, s_type, path
+        return s, s_type, "/".join(path)
 
 def download_obj(obj, obj_type, args, path):
     download_path = os.path.join(args.download, path, args.download_resource)
     os.makedirs(download_path, exist_ok=True)
     r = obj.resource(args.download_resource)
 
-    for idx, f in enumerate(r.files()):
-        if idx == 0:
-            print("Downloading files for %s: %s" % (obj_type, label(obj)))
-        f.get(os.path.join(download_path, label(f)))
+    if r.files().first() is not None:
+        print("Downloading files for %s: %s" % (obj_type, label(obj)))
+        get_resource(r, download_path, args.jobs)
+        return True
+    return False
                          
+# File in the download directory recording the objects which have been completely downloaded
+MANIFEST_FNAME = ".xnatc_manifest.jsonl"
+
+def resumable(action, args):
+    """
+    Wrap a download action so objects it downloaded data for (i.e. returned True)
+    are recorded in a manifest, and with ``--resume`` skipped if already recorded
+    """
+    os.makedirs(args.download, exist_ok=True)
+    manifest = os.path.join(args.download, MANIFEST_FNAME)
+    completed = set()
+    if args.resume and os.path.exists(manifest):
+        with open(manifest) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    completed.add((entry["format"], entry["resource"], entry["path"]))
+                except (ValueError, KeyError):
+                    # e.g. a partly written line if the previous run was killed
+                    continue
+
+    lock = threading.Lock()
+    def _action(obj, obj_type, args, path):
+        if (args.download_format, args.download_resource, path) in completed:
+            print("Skipping %s already downloaded: %s" % (obj_type, label(obj)))
+            return
+        if not action(obj, obj_type, args, path):
+            return
+        entry = {"format" : args.download_format, "resource" : args.download_resource, "path" : path}
+        with lock, open(manifest, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+    return _action
+
 def print_obj(obj, obj_type, args, path):
     prefixes = {
         "project" : "", "subject" :  " - ", "session" : "  - ", "experiment" : "  - ", "scan" : "   - ", "assessor" : "   - ",
     }
     print("%s%s: %s" % (prefixes[obj_type.lower()], obj_type, label(obj)))
 
-def do_list(conn, args, path="projects/", action=print_obj):
+def do_list_parallel(conn, args, action):
     """
-    List matching projects, subject etc
+    Run an action on matching projects, subjects etc using a pool of worker threads
+
+    At most ``2*args.jobs`` actions are queued at once and the first error stops the traversal
     """
-    projects = conn.select.projects()
-    for p in projects:
-        if matches(p, args.project, args):
-            ppath = path + label(p)
-            action(p, "project", args, ppath)
-            do_list_subjects(p, args, ppath + "/subjects/" , action)
+    if args.jobs <= 1:
+        do_list(conn, args, action=action)
+        return
 
-def do_list_subjects(proj, args, path, action):
-    subjects = proj.subjects()
+    slots = threading.BoundedSemaphore(2*args.jobs)
+    futures = set()
+    def _run(obj, obj_type, args, path):
+        try:
+            return action(obj, obj_type, args, path)
+        finally:
+            slots.release()
+
+    def _submit(obj, obj_type, args, path):
+        slots.acquire()
+        # Raise any errors from actions which have finished
+        for future in [future for future in futures if future.done()]:
+            futures.remove(future)
+            future.result()
+        futures.add(executor.submit(_run, obj, obj_type, args, path))
+
+    executor = ThreadPoolExecutor(max_workers=args.jobs)
+    try:
+        do_list(conn, args, action=_submit)
+        for future in futures:
+            future.result()
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+        raise
+    executor.shutdown()
+
+def do_list(conn, args, path=("projects",), action=print_obj):
+    """
+    List matching projects, subject etc, listing each level for all matching objects at once
+    """
+    projects = list(matching_children(conn.select.projects, args.project, args))
+    subjects = list_matching(projects, [("subjects", args.subject)], args)
+    all_subjects = [s for (p_subjects,) in subjects for s in p_subjects]
+    experiments = list_matching(all_subjects, [("experiments", args.experiment)], args)
+    all_exps = [e for (s_exps,) in experiments for e in s_exps]
+    exp_children = list_matching(all_exps, [("scans", args.scan), ("assessors", args.assessor)], args)
+
+    # Children of each subject and experiment, keyed by object identity
+    children = dict(zip(map(id, all_subjects), experiments))
+    children.update(zip(map(id, all_exps), exp_children))
+    for p, (p_subjects,) in zip(projects, subjects):
+        ppath = path + (label(p),)
+        action(p, "project", args, "/".join(ppath))
+        do_list_subjects(p_subjects, args, ppath + ("subjects",), action, children)
+
+def do_list_subjects(subjects, args, path, action, children):
     for s in subjects:
-        if matches(s, args.subject, args):
-            opath = path + label(s)
-            action(s, "subject", args, opath)
-            do_list_experiments(s, args, opath + "/experiments/", action)
+        opath = path + (label(s),)
+        action(s, "subject", args, "/".join(opath))
+        (s_experiments,) = children[id(s)]
+        do_list_experiments(s_experiments, args, opath + ("experiments",), action, children)
 
-def do_list_experiments(subj, args, path, action):
-    exps = subj.experiments()
+def do_list_experiments(exps, args, path, action, children):
     for e in exps:
-        if matches(e, args.experiment, args):
-            opath = path + label(e)
-            action(e, "experiment", args, opath)
-            do_list_scans(e, args, opath + "/scans/", action)
-            do_list_assessors(e, args, opath + "/assessors/", action)
-
-def do_list_scans(exp, args, path, action):
-    scans = exp.scans()
+        opath = path + (label(e),)
+        action(e, "experiment", args, "/".join(opath))
+        e_scans, e_assessors = children[id(e)]
+        do_list_scans(e_scans, args, opath + ("scans",), action)
+        do_list_assessors(e_assessors, args, opath + ("assessors",), action)
+
+def do_list_scans(scans, args, path, action):
     for s in scans:
-        if matches(s, args.scan, args):
-            opath = path + label(s)
-            action(s, "scan", args, opath)
+        action(s, "scan", args, "/".join(path + (label(s),)))
 
-def do_list_assessors(exp, args, path, action):
-    assessors = exp.assessors()
+def do_list_assessors(assessors, args, path, action):
     for a in assessors:
-        if matches(a, args.assessor, args):
-            opath = path + label(a)
-            action(a, "assessor", args, opath)
+        action(a, "assessor", args, "/".join(path + (label(a),)))
 
 def exact_match(obj, match_id):
-    return label(obj).lower() == match_id.lower() or obj.id().lower() == match_id.lower()
+    """
+    Check if an object's label or ID is exactly the same as a match ID, ignoring case
 
-def matches(obj, match_id, args):
-    if match_id == "skip":
-        return False
-    elif not match_id:
-        return True
+    :param match_id: Match ID, already converted to lower case
+    """
+    return match_id in (label(obj).lower(), obj_id(obj).lower())
 
-    if args.match_files and os.path.exists(match_id):
-        with open(match_id) as f:
-            match_ids = [l.strip() for l in f.readlines()]
-    else:
-        match_ids = [match_id]
+@functools.lru_cache(maxsize=1024)
+def compile_patterns(match_ids, match_type):
+    """
+    Get compiled regular expressions matching any of a tuple of glob or regex match specifications
 
-    for match_id in match_ids:
-        if args.match_type == "glob":
-            match_id = fnmatch.translate(match_id)
+    :return: Tuple of (set of literal IDs, tuple of compiled regular expressions)
+    """
+    literals = set()
+    if match_type == "glob":
+        literals = {match_id.lower() for match_id in match_ids if not GLOB_CHARS.search(match_id)}
+        match_ids = [fnmatch.translate(match_id) for match_id in match_ids if match_id.lower() not in literals]
+    if not match_ids:
+        return frozenset(literals), ()
+    try:
+        return frozenset(literals), (re.compile("|".join("(?:%s)" % match_id for match_id in match_ids), re.IGNORECASE),)
+    except re.error:
+        # e.g. a regex with global flags which are only allowed at the start
+        return frozenset(literals), tuple(re.compile(match_id, re.IGNORECASE) for match_id in match_ids)
+
+def load_match_files(args):
+    """
+    Read the ID lists from project/subject etc arguments which name files into ``args.match_ids``
+    """
+    args.match_ids = {}
+    if args.match_files:
+        for match_id in (args.project, args.subject, args.experiment, args.scan, args.assessor):
+            if match_id and os.path.exists(match_id):
+                with open(match_id) as f:
+                    args.match_ids[match_id] = tuple(l.strip() for l in f.readlines())
+
+def get_patterns(match_id, args):
+    """
+    Get the compiled patterns for a project/subject etc match specification
+    """
+    return compile_patterns(args.match_ids.get(match_id, (match_id,)), args.match_type)
+
+def match_patterns(obj, patterns):
+    literals, regexes = patterns
+    if literals and (obj_id(obj).lower() in literals or label(obj).lower() in literals):
+        return True
 
-        p = re.compile(match_id, re.IGNORECASE)
-        if p.match(obj.id()):
+    for p in regexes:
+        if p.match(obj_id(obj)):
             return True
         elif p.match(label(obj)):
             return True
 
     return False
 
+def matching_children(get_children, match_id, args):
+    """
+    Generate the children of an object which match a specification
+
+    :param get_children: Callable returning the pyxnat collection of children,
+                         e.g. ``proj.subjects``
+    """
+    if match_id == "skip":
+        return
+
+    yield from filter_children(list_children(get_children()), match_id, args)
+
+def filter_children(children, match_id, args):
+    """
+    Generate the objects from a list which match a specification
+    """
+    if not match_id:
+        yield from children
+        return
+
+    patterns = get_patterns(match_id, args)
+    for child in children:
+        if match_patterns(child, patterns):
+            yield child
+
+def list_experiments_bulk(subjects):
+    """
+    Get the experiments of each of a list of subjects using one query per project
+
+    :return: List containing a list of experiments for each subject, in the same
+             order, or None if a project listing failed
+    """
+    try:
+        return _list_experiments_bulk(subjects)
+    except AttributeError:
+        # pyxnat internals have changed - experiments are listed for each subject instead
+        return None
+
+def _list_experiments_bulk(subjects):
+    projects = {}
+    for subj in subjects:
+        projects.setdefault(subj._uri.rsplit("/subjects/", 1)[0], []).append(subj)
+
+    subject_exps = {}
+    for project_uri, project_subjects in projects.items():
+        try:
+            rows = project_subjects[0]._intf._get_json("%s/experiments?format=json&columns=ID,label,subject_ID" % project_uri)
+            for row in rows:
+                subject_exps.setdefault(row["subject_ID"], []).append(row)
+        except Exception as exc:
+            print("WARNING: Failed to list experiments for %s: %s" % (project_uri, str(exc)))
+            return None
+
+    subjects_exps = []
+    for subj in subjects:
+        exps = []
+        for row in subject_exps.get(subj._urn, []):
+            exp = subj.experiment(row["ID"])
+            exp._xnatc_id = row["ID"]
+            exp._xnatc_label = row["label"]
+            exps.append(exp)
+        subjects_exps.append(exps)
+    return subjects_exps
+
+def list_matching(objs, specs, args):
+    """
+    Get the matching children of each of a list of objects, e.g. the scans and assessors of several experiments
+
+    With ``args.jobs > 1`` all the listings are made concurrently in a single pool of worker threads
+
+    :param specs: Sequence of (child type, match specification) pairs. The child type is the name
+                  of the pyxnat method returning the collection of children, e.g. ``subjects``
+    :return: List containing a list of matching children for each spec, for each object in the same order
+    """
+    results = [[[] for _spec in specs] for _obj in objs]
+    tasks = []
+    for spec_idx, (child_type, match_id) in enumerate(specs):
+        if match_id == "skip":
+            continue
+        if child_type == "experiments" and len(objs) > 1:
+            subjects_exps = list_experiments_bulk(objs)
+            if subjects_exps is not None:
+                for obj_results, exps in zip(results, subjects_exps):
+                    obj_results[spec_idx] = list(filter_children(exps, match_id, args))
+                continue
+        tasks += [(obj_results, spec_idx, getattr(obj, child_type), match_id) for obj, obj_results in zip(objs, results)]
+
+    def _list(task):
+        obj_results, spec_idx, get_children, match_id = task
+        obj_results[spec_idx] = list(matching_children(get_children, match_id, args))
+
+    if args.jobs > 1 and len(tasks) > 1:
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            list(executor.map(_list, tasks))
+    else:
+        for task in tasks:
+            _list(task)
+    return results
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,144 @@
+"""
+Utility functions shared by xnatc modules
+"""
+import collections
+import io
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Size of chunks used when streaming downloaded files to disk
+DOWNLOAD_CHUNK_SIZE = 1024*1024
+
+# Resource zip archives smaller than this are held in memory rather than
+# written to a temporary file before extraction
+MAX_IN_MEMORY_ZIP_SIZE = 64*1024*1024
+
+def get_file(xnat_file, dest):
+    """
+    Download an XNAT file to a local path, streaming it to disk in large chunks
+    """
+    response = xnat_file._intf.get(xnat_file._uri, stream=True)
+    try:
+        if response.status_code != 200:
+            raise RuntimeError("Failed to download file %s: %i" % (dest, response.status_code))
+        # Response chunks can be smaller than requested so buffer writes too
+        with open(dest, "wb", buffering=DOWNLOAD_CHUNK_SIZE) as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+    finally:
+        response.close()
+    return dest
+
+def get_files(downloads, jobs=1):
+    """
+    Download multiple XNAT files
+
+    :param downloads: Sequence of (XNAT file, local path) pairs
+    :param jobs: Maximum number of files to download in parallel
+    """
+    if jobs > 1 and len(downloads) > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            list(executor.map(lambda download: get_file(*download), downloads))
+    else:
+        for xnat_file, dest in downloads:
+            get_file(xnat_file, dest)
+
+def _extract_member(archive, zinfo, fname):
+    # Open by ZipInfo so the member is not looked up again by name
+    with archive.open(zinfo) as src, open(fname, "wb", buffering=DOWNLOAD_CHUNK_SIZE) as dest:
+        shutil.copyfileobj(src, dest, DOWNLOAD_CHUNK_SIZE)
+
+def _write_file(fname, data):
+    with open(fname, "wb") as f:
+        f.write(data)
+
+# XNAT puts resource files under <experiment>/.../resources/<resource>/files/ within zip archives
+XNAT_ZIP_PREFIX = re.compile(r"^.*?/resources/[^/]+/files/")
+
+def _member_path(dest_dir, zinfo):
+    """
+    Get the local path to extract a zip member to, relative to its resource
+    folder so subfolders are kept, or None if it is unsafe
+    """
+    relpath = XNAT_ZIP_PREFIX.sub("", zinfo.filename)
+    relpath = os.path.normpath(relpath)
+    if os.path.isabs(relpath) or relpath.split(os.sep)[0] in ("..", "."):
+        return None
+    return os.path.join(dest_dir, relpath)
+
+def extract_zip(zip_file, dest_dir, jobs=1):
+    """
+    Extract all the files in a zip archive into a local directory
+
+    :param zip_file: File name or seekable file-like object
+    :param jobs: Maximum number of files to write in parallel
+    """
+    with zipfile.ZipFile(zip_file) as archive:
+        members = []
+        for zinfo in archive.infolist():
+            if zinfo.is_dir():
+                continue
+            fname = _member_path(dest_dir, zinfo)
+            if fname is None:
+                print("WARNING: Not extracting %s - path is outside the download directory" % zinfo.filename)
+                continue
+            members.append((zinfo, fname))
+
+        for dirname in {os.path.dirname(fname) for _zinfo, fname in members} | {dest_dir}:
+            os.makedirs(dirname, exist_ok=True)
+
+        # ZipFile is not thread safe so members are decompressed in this thread
+        # and only small files are written by the worker threads
+        if jobs <= 1 or len(members) <= 1:
+            for zinfo, fname in members:
+                _extract_member(archive, zinfo, fname)
+            return
+
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for zinfo, fname in members:
+                if zinfo.file_size > DOWNLOAD_CHUNK_SIZE:
+                    _extract_member(archive, zinfo, fname)
+                    continue
+                pending.append(executor.submit(_write_file, fname, archive.read(zinfo)))
+                # Limit the number of decompressed files waiting to be written
+                if len(pending) > 2*jobs:
+                    pending.popleft().result()
+            for future in pending:
+                future.result()
+
+def _spool_to_disk(mem_file):
+    """
+    Move a partly downloaded archive from memory to a temporary file
+    """
+    disk_file = tempfile.TemporaryFile(buffering=DOWNLOAD_CHUNK_SIZE)
+    disk_file.write(mem_file.getbuffer())
+    mem_file.close()
+    return disk_file
+
+def get_resource(resource, dest_dir, jobs=1):
+    """
+    Download all the files in an XNAT resource into a local directory as a single zip archive
+
+    :param jobs: Maximum number of files to write in parallel when extracting
+    """
+    response = resource._intf.get(resource._uri + "/files?format=zip", stream=True)
+    try:
+        if response.status_code != 200:
+            raise RuntimeError("Failed to download resource to %s: %i" % (dest_dir, response.status_code))
+        zip_file = io.BytesIO()
+        try:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                zip_file.write(chunk)
+                if isinstance(zip_file, io.BytesIO) and zip_file.tell() > MAX_IN_MEMORY_ZIP_SIZE:
+                    zip_file = _spool_to_disk(zip_file)
+            zip_file.seek(0)
+            extract_zip(zip_file, dest_dir, jobs)
+        finally:
+            zip_file.close()
+    finally:
+        response.close()